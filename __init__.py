@@ -25,6 +25,18 @@ Remote imports
 .. automodule:: condor.github
     :members: GithubConnect, GithubImporter
 
+.. automodule:: condor.bench
+    :members: Throttle, Benchmark
+
+MPI netCDF
+==========
+
+.. automodule:: condor.mpicdf
+    :members: Data, Plan, tiled, label_slice
+
+.. automodule:: condor.mpibench
+    :members: ComputeBenchmark
+
 """
 from .sshfs import enable_sshfs_import, disable_sshfs_import
 from .github import enable_github_import, disable_github_import
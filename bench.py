@@ -0,0 +1,346 @@
+#!/usr/bin/env python
+"""
+Benchmarks
+----------
+
+Local benchmark harness for the remote import machinery. Instead of a real cluster or the real GitHub api, two in-process stand-ins are started on the loopback interface:
+
+    * an SFTP server (built on `paramiko <http://www.paramiko.org>`_) which serves a local directory to :class:`~.sshfs.SSHFSImporter`
+    * an HTTP server which mimics the `GitHub contents api <https://developer.github.com/v3/repos/contents/>`_ for :class:`~.github.GithubImporter`
+
+Both serve a generated package tree of configurable width and depth, and every request they answer goes through a :class:`Throttle`, which injects a fixed per-request latency plus a bandwidth-limited transfer time and counts requests and bytes (file contents as well as the listing and stat replies, so that the byte counts of both backends are comparable). For each backend, the time to connect, the time for a *cold* import (fresh importer, empty caches) and for a *warm* import (same importer, modules removed from :data:`sys.modules`) are reported together with the request counts and bytes transferred.
+
+The harness is a traitlets :class:`~traitlets.config.Application` like :class:`~.sshfs.SSHFSRunner`, so all parameters of :class:`Benchmark` can be given on the command line::
+
+    python -m condor.bench --width=4 --depth=2 --latency=0.05 --bandwidth=1e6
+
+"""
+from importlib import import_module
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit
+from traitlets.config import Application
+from traitlets import Unicode, Integer, Float, List
+from contextlib import redirect_stdout
+import paramiko
+import sys, os, io, json, time, socket, threading, tempfile
+
+
+class Throttle(object):
+    """Latency / bandwidth injection and request accounting, shared by the stand-in servers. Each call to an instance counts as one request and sleeps for ``latency + nbytes / bandwidth`` seconds.
+
+    :param latency: per-request latency in seconds
+    :param bandwidth: bandwidth in bytes per second (``0`` means unlimited)
+
+    Attributes::
+
+        **requests** - number of requests since the last :meth:`reset`
+        **bytes** - number of payload bytes transferred since the last :meth:`reset`
+
+    """
+    def __init__(self, latency=0., bandwidth=0.):
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.requests = 0
+            self.bytes = 0
+
+    def __call__(self, nbytes=0):
+        with self.lock:
+            self.requests += 1
+            self.bytes += nbytes
+        delay = self.latency + (nbytes / self.bandwidth if self.bandwidth > 0 else 0)
+        if delay > 0:
+            time.sleep(delay)
+
+def make_tree(root, name='benchpkg', width=3, depth=2, size=1024):
+    """Generate a package tree below ``root``: every package contains ``width`` modules and (down to ``depth`` levels) ``width`` subpackages. Each file is padded with comments to roughly ``size`` bytes.
+
+    :returns: list of all fully qualified module names, parents before children
+
+    """
+    names = []
+    def fill(path, fullname, level):
+        os.makedirs(path)
+        names.append(fullname)
+        write(os.path.join(path, '__init__.py'), fullname)
+        for i in range(width):
+            mod = 'm{}'.format(i)
+            write(os.path.join(path, '{}.py'.format(mod)), '{}.{}'.format(fullname, mod))
+            names.append('{}.{}'.format(fullname, mod))
+        if level < depth:
+            for i in range(width):
+                pkg = 'p{}'.format(i)
+                fill(os.path.join(path, pkg), '{}.{}'.format(fullname, pkg), level + 1)
+    def write(path, fullname):
+        s = 'NAME = {!r}\n'.format(fullname)
+        line = '# {}\n'.format('x' * 76)
+        with open(path, 'w') as f:
+            f.write(s + line * max(0, (size - len(s)) // len(line)))
+    fill(os.path.join(root, name), name, 1)
+    return names
+
+
+class _SFTPHandle(paramiko.SFTPHandle):
+    def __init__(self, f, throttle):
+        super().__init__()
+        self.readfile = f
+        self.throttle = throttle
+
+    def read(self, offset, length):
+        data = super().read(offset, length)
+        if isinstance(data, bytes):
+            self.throttle(len(data))
+        return data
+
+    def stat(self):
+        return paramiko.SFTPAttributes.from_stat(os.fstat(self.readfile.fileno()))
+
+def _attr_size(attr, name=False):
+    # size of the attributes as sent in an SFTP reply (plus filename and long name in listings)
+    m = paramiko.Message()
+    attr._pack(m)
+    n = len(m.asbytes())
+    if name:
+        n += 8 + len(attr.filename.encode()) + len(str(attr).encode())
+    return n
+
+class _SFTPInterface(paramiko.SFTPServerInterface):
+    """Read-only SFTP view of the local directory ``root``."""
+    def __init__(self, server, root, throttle, *args, **kwargs):
+        super().__init__(server, *args, **kwargs)
+        self.root = root
+        self.throttle = throttle
+
+    def _local(self, path):
+        return os.path.join(self.root, self.canonicalize(path).lstrip('/'))
+
+    def list_folder(self, path):
+        try:
+            p = self._local(path)
+            attrs = [paramiko.SFTPAttributes.from_stat(os.stat(os.path.join(p, f)), f) for f in os.listdir(p)]
+        except OSError as e:
+            self.throttle()
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        self.throttle(sum(_attr_size(a, True) for a in attrs))
+        return attrs
+
+    def stat(self, path):
+        try:
+            attr = paramiko.SFTPAttributes.from_stat(os.stat(self._local(path)))
+        except OSError as e:
+            self.throttle()
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        self.throttle(_attr_size(attr))
+        return attr
+
+    lstat = stat
+
+    def open(self, path, flags, attr):
+        self.throttle()
+        if flags & (os.O_WRONLY | os.O_RDWR):
+            return paramiko.SFTP_PERMISSION_DENIED
+        try:
+            return _SFTPHandle(open(self._local(path), 'rb'), self.throttle)
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+class _SSHServer(paramiko.ServerInterface):
+    def get_allowed_auths(self, username):
+        return 'publickey'
+
+    def check_auth_publickey(self, username, key):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_channel_request(self, kind, chanid):
+        if kind == 'session':
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+class SFTPStandIn(object):
+    """In-process SFTP server on the loopback interface, serving ``root`` (read-only) to any client key. The client key file to hand to :class:`~.sshfs.SSHFSConnect` is available as :attr:`pkey`, the port as :attr:`port`."""
+    def __init__(self, root, throttle):
+        self.root = root
+        self.throttle = throttle
+        self.host_key = paramiko.RSAKey.generate(2048)
+        self.pkey = os.path.join(root, '.bench_key')
+        paramiko.RSAKey.generate(2048).write_private_key_file(self.pkey)
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen(8)
+        self.port = self.sock.getsockname()[1]
+        self.transports = []
+        threading.Thread(target=self._accept, daemon=True).start()
+
+    def _accept(self):
+        while True:
+            try:
+                conn, addr = self.sock.accept()
+            except OSError:
+                return
+            t = paramiko.Transport(conn)
+            t.add_server_key(self.host_key)
+            t.set_subsystem_handler('sftp', paramiko.SFTPServer, _SFTPInterface, self.root, self.throttle)
+            t.start_server(server=_SSHServer())
+            self.transports.append(t)
+
+    def close(self):
+        self.sock.close()
+        for t in self.transports:
+            t.close()
+
+
+class _ContentsHandler(BaseHTTPRequestHandler):
+    def _entry(self, rel):
+        srv = self.server
+        isdir = os.path.isdir(os.path.join(srv.root, rel))
+        return {
+            'name': os.path.basename(rel),
+            'path': rel,
+            'type': 'dir' if isdir else 'file',
+            'download_url': None if isdir else '{}/raw/{}'.format(srv.url, rel),
+            '_links': {'self': '{}{}{}'.format(srv.url, srv.prefix, rel)}
+        }
+
+    def do_GET(self):
+        srv = self.server
+        path = urlsplit(self.path).path
+        body, ctype = None, 'application/json'
+        if path.startswith(srv.prefix):
+            rel = path[len(srv.prefix):].strip('/')
+            local = os.path.join(srv.root, rel)
+            if os.path.isdir(local):
+                body = json.dumps([self._entry(os.path.join(rel, f)) for f in sorted(os.listdir(local))])
+            elif os.path.isfile(local):
+                body = json.dumps(self._entry(rel))
+            body = None if body is None else body.encode()
+        elif path.startswith('/raw/'):
+            local = os.path.join(srv.root, path[len('/raw/'):])
+            if os.path.isfile(local):
+                with open(local, 'rb') as f:
+                    body, ctype = f.read(), 'text/plain'
+        srv.throttle(0 if body is None else len(body))
+        if body is None:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', ctype)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+class GithubStandIn(object):
+    """In-process HTTP server on the loopback interface, answering the subset of the GitHub contents api used by :class:`~.github.GithubImporter` for ``root`` as the contents of repo ``user/repo``. Its base url (to be passed as ``api`` to :class:`~.github.GithubConnect`) is :attr:`url`."""
+    def __init__(self, root, throttle, user='bench', repo='bench'):
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), _ContentsHandler)
+        self.httpd.root = root
+        self.httpd.throttle = throttle
+        self.httpd.prefix = '/repos/{}/{}/contents/'.format(user, repo)
+        self.httpd.url = self.url = 'http://127.0.0.1:{}'.format(self.httpd.server_address[1])
+        self.user, self.repo = user, repo
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+class Benchmark(Application):
+    """Benchmark the import path of :class:`~.sshfs.SSHFSImporter` and :class:`~.github.GithubImporter` against the local stand-in servers. All parameters are traits and can be set on the command line (see module docstring)."""
+
+    backends = List(['sshfs', 'github']).tag(config=True)
+    """backends to benchmark (``sshfs`` and / or ``github``)"""
+
+    width = Integer(3).tag(config=True)
+    """number of modules and subpackages per package of the generated tree"""
+
+    depth = Integer(2).tag(config=True)
+    """nesting depth of the generated package tree"""
+
+    size = Integer(1024).tag(config=True)
+    """approximate size in bytes of each generated file"""
+
+    latency = Float(0.).tag(config=True)
+    """injected per-request latency in seconds"""
+
+    bandwidth = Float(0.).tag(config=True)
+    """injected bandwidth limit in bytes per second (0 means unlimited)"""
+
+    package = Unicode('benchpkg').tag(config=True)
+    """name of the generated top-level package"""
+
+    aliases = {'width': 'Benchmark.width', 'depth': 'Benchmark.depth', 'size': 'Benchmark.size',
+               'latency': 'Benchmark.latency', 'bandwidth': 'Benchmark.bandwidth', 'backends': 'Benchmark.backends'}
+
+    def _purge(self):
+        for name in [n for n in sys.modules if n == self.package or n.startswith(self.package + '.')]:
+            sys.modules.pop(name)
+
+    def _import(self, names):
+        start = time.perf_counter()
+        with redirect_stdout(io.StringIO()):
+            for name in names:
+                import_module(name)
+        return time.perf_counter() - start
+
+    def measure(self, factory, names, throttle):
+        """Time connecting, a cold and a warm import of all ``names`` with the importer returned by ``factory``.
+
+        :returns: dict of results, one (time, requests, bytes) tuple per phase
+
+        """
+        results = {}
+        self._purge()
+        throttle.reset()
+        start = time.perf_counter()
+        importer = factory()
+        results['connect'] = (time.perf_counter() - start, throttle.requests, throttle.bytes)
+        sys.meta_path.insert(0, importer)
+        try:
+            for phase in ['cold', 'warm']:
+                self._purge()
+                throttle.reset()
+                results[phase] = (self._import(names), throttle.requests, throttle.bytes)
+        finally:
+            sys.meta_path.remove(importer)
+            self._purge()
+        return results
+
+    def start(self):
+        from .sshfs import SSHFSImporter
+        from .github import GithubImporter
+        throttle = Throttle(self.latency, self.bandwidth)
+        with tempfile.TemporaryDirectory() as root:
+            names = make_tree(os.path.join(root, 'src'), self.package, self.width, self.depth, self.size)
+            print('{} modules, width {}, depth {}, ~{} bytes each, latency {}s, bandwidth {} B/s'.format(
+                len(names), self.width, self.depth, self.size, self.latency, self.bandwidth or 'unlimited'))
+            print('{:8s} {:8s} {:>10s} {:>10s} {:>12s}'.format('backend', 'phase', 'time [s]', 'requests', 'bytes'))
+            for backend in self.backends:
+                if backend == 'sshfs':
+                    server = SFTPStandIn(root, throttle)
+                    factory = lambda: SSHFSImporter(host='127.0.0.1', port=server.port, user='bench',
+                                                    pkey=server.pkey, path='/src')
+                elif backend == 'github':
+                    server = GithubStandIn(root, throttle)
+                    factory = lambda: GithubImporter(user=server.user, repo=server.repo, folder='src',
+                                                     token='bench', api=server.url)
+                else:
+                    raise ValueError('unknown backend {}'.format(backend))
+                try:
+                    results = self.measure(factory, names, throttle)
+                finally:
+                    server.close()
+                for phase, (t, n, b) in results.items():
+                    print('{:8s} {:8s} {:10.4f} {:10d} {:12d}'.format(backend, phase, t, n, b))
+
+if __name__ == '__main__':
+    app = Benchmark()
+    app.initialize()
+    app.start()
@@ -21,17 +21,18 @@ class GithubConnect(object):
         * **repo** - GitHub repo name
         * **folder** - root folder within repo in which to anchor any search
         * **token** - GitHub api token
+        * **api** - base url of the GitHub api (can be pointed at a stand-in server, e.g. by :mod:`condor.bench`)
 
     """
-    def __init__(self, user=None, repo=None, folder=None, token=None):
-        if not all(user, repo, folder, token):
+    def __init__(self, user=None, repo=None, folder=None, token=None, api='https://api.github.com'):
+        if not all((user, repo, folder, token)):
             if 'cezar' not in globals():
                 import runpy
                 gh = runpy.run_path(os.path.expanduser(os.environ['PYTHONSTARTUP']))['cezar']['github']
             else:
                 gh = cezar['github']
 
-        api = requests.utils.urlparse('https://api.github.com')
+        api = requests.utils.urlparse(api)
         self.params = {'token': gh['token'] if token is None else token}
         self.user = gh['user'] if user is None else user
         self.repo = gh['repo'] if repo is None else repo
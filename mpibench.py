@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+"""
+MPI compute benchmark
+---------------------
+
+Compare ranks-only against ranks × threads configurations of the per-processor work in :mod:`condor.mpicdf`. Run under MPI, :class:`ComputeBenchmark` reads a variable with :class:`~.mpicdf.Data`, times :meth:`~.mpicdf.Data.np_op` and :meth:`~.mpicdf.Data.trend` with the given number of threads per rank and reports the maximum time over all ranks::
+
+    mpiexec -n 8 python -m condor.mpibench --path=data.nc --var=t2 --dim=lat --ax=time --threads=8
+
+Given a list of ``ranksxthreads`` configurations, it instead launches one ``mpiexec`` run per configuration and prints all results in one table::
+
+    python -m condor.mpibench --path=data.nc --var=t2 --dim=lat --ax=time --configs=64x1 --configs=16x4 --configs=8x8
+
+The runs launched this way have ``OMP_NUM_THREADS``, ``OPENBLAS_NUM_THREADS`` and ``MKL_NUM_THREADS`` set to 1, so that the only threads are those of the pool; set them likewise when running a single measurement under ``mpiexec`` directly (and export them to remote nodes if the launcher does not do so by itself).
+
+"""
+from traitlets.config import Application
+from traitlets import Unicode, Integer, List, Bool
+import sys, os, subprocess
+
+# BLAS / OpenMP libraries start their own threads (e.g. in the LAPACK call of Data.trend), pin them to one
+_single_threaded = {'OMP_NUM_THREADS': '1', 'OPENBLAS_NUM_THREADS': '1', 'MKL_NUM_THREADS': '1'}
+
+
+class ComputeBenchmark(Application):
+    """Benchmark the thread-pool layer of :mod:`condor.mpicdf`. All parameters are traits and can be set on the command line (see module docstring)."""
+
+    path = Unicode().tag(config=True)
+    """path to the netCDF file"""
+
+    var = Unicode().tag(config=True)
+    """variable to read"""
+
+    dim = Unicode().tag(config=True)
+    """dimension along which the data is distributed over the ranks"""
+
+    ax = Unicode('time').tag(config=True)
+    """dimension to reduce over (must not be :attr:`dim` for the trend to be meaningful)"""
+
+    op = Unicode('mean').tag(config=True)
+    """reduction method handed to :meth:`~.mpicdf.Data.np_op`"""
+
+    threads = Integer(1).tag(config=True)
+    """number of threads per rank"""
+
+    repeat = Integer(3).tag(config=True)
+    """number of repetitions (the best one is reported)"""
+
+    configs = List(Unicode()).tag(config=True)
+    """``ranksxthreads`` configurations to launch via ``mpiexec`` (if empty, run a single measurement)"""
+
+    mpiexec = Unicode('mpiexec').tag(config=True)
+    """MPI launcher"""
+
+    header = Bool(True).tag(config=True)
+    """whether to print the table header"""
+
+    aliases = {'path': 'ComputeBenchmark.path', 'var': 'ComputeBenchmark.var', 'dim': 'ComputeBenchmark.dim',
+               'ax': 'ComputeBenchmark.ax', 'op': 'ComputeBenchmark.op', 'threads': 'ComputeBenchmark.threads',
+               'repeat': 'ComputeBenchmark.repeat', 'configs': 'ComputeBenchmark.configs',
+               'mpiexec': 'ComputeBenchmark.mpiexec'}
+
+    flags = {'no-header': ({'ComputeBenchmark': {'header': False}}, 'do not print the table header')}
+
+    columns = '{:>6s} {:>8s} {:>10s} {:>10s} {:>10s}'.format('ranks', 'threads', 'read [s]', 'np_op [s]', 'trend [s]')
+
+    def measure(self):
+        from mpi4py import MPI
+        from .mpicdf import Data
+        import numpy as np
+        data = Data(self.path, var=self.var, dim=self.dim, threads=self.threads)
+        ax = data.var.dimensions.index(self.ax)
+        t_op, t_trend = np.inf, np.inf
+        for i in range(self.repeat):
+            data.np_op({self.ax: self.op})
+            t_op = min(t_op, data.op_time)
+            t_trend = min(t_trend, data.trend(ax)[-1])
+        t = MPI.COMM_WORLD.reduce(np.array([data.read_time, t_op, t_trend]), op=MPI.MAX, root=0)
+        if MPI.COMM_WORLD.rank == 0:
+            print('{:6d} {:8d} {:10.4f} {:10.4f} {:10.4f}'.format(MPI.COMM_WORLD.Get_size(), self.threads, *t))
+
+    def sweep(self):
+        print(self.columns)
+        for c in self.configs:
+            ranks, threads = c.split('x')
+            args = [a for a in sys.argv[1:] if not a.startswith('--configs') and not a.startswith('--threads')]
+            out = subprocess.run([self.mpiexec, '-n', ranks, sys.executable, '-m', 'condor.mpibench',
+                                  '--threads={}'.format(threads), '--no-header'] + args,
+                                 env=dict(os.environ, **_single_threaded),
+                                 stdout=subprocess.PIPE, universal_newlines=True, check=True).stdout
+            print(out.strip())
+
+    def start(self):
+        if len(self.configs) > 0:
+            self.sweep()
+        else:
+            from mpi4py import MPI
+            if MPI.COMM_WORLD.rank == 0 and self.header:
+                print(self.columns)
+            self.measure()
+
+if __name__ == '__main__':
+    app = ComputeBenchmark()
+    app.initialize()
+    app.start()
@@ -1,5 +1,25 @@
+"""
+mpicdf
+------
+
+Parallel (MPI) reading of netCDF files, with each processor holding a slice of a variable along one dimension (:class:`Data`), and reductions, trends and time-grouped aggregations computed on the processors (:meth:`Data.np_op`, :meth:`Data.trend`, :meth:`Data.groupby`, :class:`Plan`).
+
+"""
 from mpi4py import MPI
-from netCDF4 import Dataset, num2date
+from netCDF4 import Dataset, num2date, date2num
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+n_threads = 1
+"""default number of threads per processor for :meth:`Data.np_op`, :meth:`Data.trend` and :class:`Plan`"""
+
+tile_size = 2 ** 20
+"""approximate size in bytes of the tiles handed to the threads (of the order of a per-core L2 cache)"""
+
+_pools = {}
+
+# per-file cache of label -> index translations, see :meth:`Data._label_slice`
+_label_cache = {}
 
 class Data(object):
     """Open, read and attach - as :attr:`x` - a slice of netCDF data.
@@ -9,38 +29,64 @@ class Data(object):
     Keyword arguments::
 
         **var** - the variable in the netCDF dataset to read
-        **dim** - the dimension along which to slice the data (each processor gets len(dim) / nproc of the data)
+        **dim** - the dimension along which to slice the data (each processor gets len(dim) / nproc of the data, the last len(dim) % nproc processors one step more)
         **copy** - development hack to copy the data (``x``) over to a fresh instance of :class:`Data`
+        **netcdf** - an already opened :class:`~netCDF4.Dataset` to use instead of opening **path** again
+        **read** - if ``False``, only compute :attr:`slices` without reading the data (used by :class:`Plan`)
+        **threads** - number of threads used by :meth:`np_op` and :meth:`trend` (default :data:`n_threads`)
 
-    Either **var** and **dim** or **copy** are needed. Any additional **kwargs** should be in the form of ``name=slice()``, where **name** refers to a dimension name, and the corresponding slice will be applied to the read operation.
+    Either **var** and **dim** or **copy** are needed. Any additional **kwargs** should be in the form of ``name=slice()``, where **name** refers to a dimension name, and the corresponding slice will be applied to the read operation. Instead of an index ``slice``, a tuple ``(start, stop)`` of coordinate values can be given, e.g. ``Data(path, var='t2', dim='time', time=('1990', '2000'), lat=(-40, -20))``. Both bounds are inclusive; for time coordinates (with units ``'... since ...'``) the labels can be (partial) date strings, which include the whole period they denote. The translation to indices is done once on rank 0 and broadcast. If **dim** itself is restricted, the selected range (which must have step 1) is divided among the processors.
 
     Attributes::
 
         **x** - the data
         **read_time** - the wall time needed to read the data
+        **mpi_range** - the ``slice`` along **dim** divided among all processors
 
     """
     def __init__(self, path=None, **kwargs):
         if 'copy' in kwargs:
             copy = kwargs.pop('copy')
-            for a in ['x', 'netcdf', 'var', 'mpi_dim', 'slices']:
+            for a in ['x', 'netcdf', 'var', 'mpi_dim', 'mpi_range', 'slices']:
                 setattr(self, a, getattr(copy, a))
+            self.threads = kwargs.pop('threads', getattr(copy, 'threads', None))
         else:
             start = MPI.Wtime()
-            self.netcdf = Dataset(path, parallel=True, comm=MPI.COMM_WORLD)
+            self.netcdf = kwargs.pop('netcdf', None)
+            if self.netcdf is None:
+                self.netcdf = Dataset(path, parallel=True, comm=MPI.COMM_WORLD)
             self.var = self.netcdf[kwargs.pop('var')]
+            read = kwargs.pop('read', True)
+            self.threads = kwargs.pop('threads', None)
             self.mpi_dim = kwargs.pop('dim')
-            n = int(self.netcdf[self.mpi_dim].shape[0] / MPI.COMM_WORLD.Get_size())
-            self.slices = self._slicer(n, **kwargs)
-            self.x = self.var[self.slices]
+            for d, s in kwargs.items():
+                if isinstance(s, tuple):
+                    kwargs[d] = self._label_slice(d, s)
+            offset, stop, step = kwargs.pop(self.mpi_dim, slice(None)).indices(self.netcdf[self.mpi_dim].shape[0])
+            if step != 1:
+                raise ValueError('slice along the decomposed dimension {} must have step 1'.format(self.mpi_dim))
+            self.mpi_range = slice(offset, max(offset, stop))
+            n, r = divmod(self.mpi_range.stop - offset, MPI.COMM_WORLD.Get_size())
+            rank = MPI.COMM_WORLD.rank
+            # the remainder goes to the last r processors, one step each
+            i = offset + rank * n + max(0, rank - (MPI.COMM_WORLD.Get_size() - r))
+            self.slices = self._slicer(slice(i, i + n + (rank >= MPI.COMM_WORLD.Get_size() - r)), **kwargs)
+            if read:
+                self.x = self.var[self.slices]
             self.read_time = MPI.Wtime() - start
 
-    def _slicer(self, n = None, **kwargs):
+    def _label_slice(self, dim, labels):
+        key = (self.netcdf.filepath(), dim, labels)
+        if key not in _label_cache:
+            s = label_slice(self.netcdf[dim], labels) if MPI.COMM_WORLD.rank == 0 else None
+            _label_cache[key] = MPI.COMM_WORLD.bcast(s, root=0)
+        return _label_cache[key]
+
+    def _slicer(self, rank_slice = None, **kwargs):
         slices = []
-        rank = MPI.COMM_WORLD.rank
         for d in self.var.dimensions:
-            if d == self.mpi_dim and n is not None:
-                slices.append(slice(rank * n, (rank+1) * n))
+            if d == self.mpi_dim and rank_slice is not None:
+                slices.append(rank_slice)
             elif d in kwargs:
                 slices.append(kwargs[d])
             else:
@@ -55,7 +101,7 @@ class Data(object):
                 name = self.var.dimensions[d]
                 var = self.netcdf[name]
                 if var.name == time:
-                    coords.append((name, num2date(var[:], var.units)))
+                    coords.append((name, num2date(var[self.slices[d]], var.units)))
                 else:
                     coords.append((name, var[self.slices[d]]))
         self.xr = xr.DataArray(self.x.squeeze(), coords=coords)
@@ -65,18 +111,304 @@ class Data(object):
         start = MPI.Wtime()
         ax, func = op.popitem()
         dim = self.var.dimensions.index(ax)
+        y = tiled(lambda z: getattr(z, func)(dim), x, dim, self.threads)
         self.op_time = MPI.Wtime() - start
-        return getattr(x, func)(dim)
+        return y
+
+    def groupby(self, by, op='mean', time='time'):
+        """Aggregate :attr:`x` over groups of the time coordinate, without moving the data off the processors. Each processor computes per-group partial sums and counts (ignoring missing values) of its slice; if **time** is the decomposed dimension, these are combined with an ``Allreduce``, otherwise each processor returns its piece of the result (as for :meth:`np_op`).
+
+        :param by: grouping of the decoded time coordinate - ``'month'`` or ``'season'`` for climatologies, ``'year'``, ``'yearmonth'`` or ``'date'`` for resampling to yearly, monthly or daily values
+        :param op: ``'mean'``, ``'sum'`` or ``'count'``
+        :param time: name of the time dimension
+        :returns: list of group keys and the aggregated data, with the time axis replaced by the groups
+
+        """
+        if by not in _groupers or op not in ['mean', 'sum', 'count']:
+            raise ValueError('unknown grouping {} or operation {}'.format(by, op))
+        start = MPI.Wtime()
+        ax = self.var.dimensions.index(time)
+        var = self.netcdf[time]
+        dates = num2date(var[self.slices[ax]], var.units, getattr(var, 'calendar', 'standard'))
+        local = [_groupers[by](d) for d in np.atleast_1d(dates)]
+        keys = sorted(set().union(*MPI.COMM_WORLD.allgather(set(local))))
+        idx = {k: i for i, k in enumerate(keys)}
+        g = np.array([idx[k] for k in local], dtype=int)
+        # group axis first; masked values contribute zero to the sums and counts
+        valid = np.moveaxis(~np.ma.getmaskarray(self.x), ax, 0)
+        x = np.where(valid, np.moveaxis(np.ma.getdata(self.x), ax, 0), 0).astype(float)
+        sums, counts = np.zeros((len(keys),) + x.shape[1:]), np.zeros((len(keys),) + x.shape[1:])
+        if g.size > 0:
+            order = np.argsort(g, kind='stable')
+            i, first = np.unique(g[order], return_index=True)
+            sums[i] = np.add.reduceat(x[order], first, axis=0)
+            counts[i] = np.add.reduceat(valid[order].astype(float), first, axis=0)
+        sums, counts = np.moveaxis(sums, 0, ax), np.moveaxis(counts, 0, ax)
+        shape = sums.shape
+        if time == self.mpi_dim:
+            buf = np.concatenate((sums.ravel(), counts.ravel()))
+            MPI.COMM_WORLD.Allreduce(MPI.IN_PLACE, buf, op=MPI.SUM)
+            sums, counts = buf[:sums.size].reshape(shape), buf[sums.size:].reshape(shape)
+        self.op_time = MPI.Wtime() - start
+        if by in _group_labels:
+            keys = [_group_labels[by][k] for k in keys]
+        if op == 'sum':
+            return keys, sums
+        if op == 'count':
+            return keys, counts
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return keys, np.where(counts > 0, sums / counts, np.nan)
 
     def trend(self, ax):
         start = MPI.Wtime()
-        n = x.shape[ax]
-        i = list(range(x.ndim))
+        n = self.x.shape[ax]
+        i = list(range(self.x.ndim))
         i.remove(ax)
         i.append(ax)
         x = self.x.transpose(i).reshape((-1, n)).T
         t = np.r_['1', np.ones((n, 1)), np.arange(n).reshape((-1, 1))]
-        return np.linalg.lstsq(t, x)[0][1, :], self.dim, self.read_time, MPI.Wtime() - start
+        b = tiled(lambda z: np.linalg.lstsq(t, z, rcond=None)[0][1, :], x, 0, self.threads)
+        return b, self.slices, self.read_time, MPI.Wtime() - start
+
+def tiled(func, x, ax, threads=None):
+    """Apply the reduction **func** along axis **ax** of **x** on a thread pool, by splitting **x** into tiles of about :data:`tile_size` bytes along its longest non-reduced axis and concatenating the results. NumPy releases the GIL in its ufunc loops and LAPACK calls, so the tiles are processed concurrently. With one thread (or nothing to split), ``func(x)`` is returned directly.
+
+    .. Note::
+
+        Multithreaded BLAS / OpenMP libraries (as used by numpy's LAPACK calls, e.g. in :meth:`Data.trend`) start their own threads inside each tile, which oversubscribes the cores. Set ``OMP_NUM_THREADS=1`` / ``OPENBLAS_NUM_THREADS=1`` (or use ``threadpoolctl``) when using more than one thread per processor.
+
+    :param func: function of one array argument, operating along axis **ax** only - it may either remove that axis (a reduction) or keep all axes (e.g. ``cumsum``)
+    :param x: the array
+    :param ax: index of the reduced axis
+    :param threads: number of threads (default :data:`n_threads`)
+
+    """
+    threads = threads or n_threads
+    axes = [a for a in range(x.ndim) if a != ax]
+    if threads <= 1 or len(axes) == 0:
+        return func(x)
+    s = max(axes, key=lambda a: x.shape[a])
+    k = min(x.shape[s], max(threads, -(-x.nbytes // tile_size)))
+    if k <= 1:
+        return func(x)
+    if threads not in _pools:
+        _pools[threads] = ThreadPoolExecutor(threads)
+    y = list(_pools[threads].map(func, np.array_split(x, k, axis=s)))
+    if np.ndim(y[0]) == x.ndim:
+        k = s
+    elif np.ndim(y[0]) == x.ndim - 1:
+        k = s - 1 if s > ax else s
+    else:
+        return func(x)
+    concat = np.ma.concatenate if isinstance(y[0], np.ma.MaskedArray) else np.concatenate
+    return concat(y, k)
+
+def _date_bound(label, units, calendar, upper=False):
+    # partial date strings cover their whole period, hence the exclusive upper bound
+    if isinstance(label, str):
+        d = np.datetime64(label)
+        if upper:
+            return date2num((d + 1).astype('datetime64[s]').item(), units, calendar), 'left'
+        label = d
+    if isinstance(label, np.datetime64):
+        label = label.astype('datetime64[s]').item()
+    return date2num(label, units, calendar), 'right' if upper else 'left'
+
+def label_slice(coord, labels):
+    """Translate a ``(start, stop)`` tuple of coordinate values into an index ``slice`` along the (monotonic) coordinate variable ``coord``, by binary search. Both bounds are inclusive; descending coordinates (e.g. latitude from north to south) are handled as well.
+
+    :param coord: netCDF coordinate variable
+    :param labels: tuple of (start, stop) coordinate values, or date strings / datetimes if **coord** is a time coordinate
+
+    """
+    lo, hi = labels
+    units = getattr(coord, 'units', '')
+    if ' since ' in units:
+        calendar = getattr(coord, 'calendar', 'standard')
+        (lo, lo_side), (hi, hi_side) = _date_bound(lo, units, calendar), _date_bound(hi, units, calendar, True)
+    else:
+        lo, hi = min(lo, hi), max(lo, hi)
+        lo_side, hi_side = 'left', 'right'
+    c = np.asarray(coord[:])
+    if c.size > 1 and c[0] > c[-1]:
+        # descending coordinate: search the negated (ascending) values with mirrored bounds
+        flip = {'left': 'right', 'right': 'left'}
+        i, j = np.searchsorted(-c, -hi, flip[hi_side]), np.searchsorted(-c, -lo, flip[lo_side])
+    else:
+        i, j = np.searchsorted(c, lo, lo_side), np.searchsorted(c, hi, hi_side)
+    return slice(int(i), int(j))
+
+# group keys for :meth:`Data.groupby` (sortable, translated via _group_labels where needed)
+_groupers = {
+    'month': lambda d: d.month,
+    'season': lambda d: d.month % 12 // 3,
+    'year': lambda d: d.year,
+    'yearmonth': lambda d: (d.year, d.month),
+    'date': lambda d: (d.year, d.month, d.day),
+}
+_group_labels = {'season': ['DJF', 'MAM', 'JJA', 'SON']}
+
+# partial results needed by each operation of a :class:`Plan`, and how they combine
+_needs = {
+    'sum': ['sum'],
+    'mean': ['sum', 'count'],
+    'std': ['sum', 'sumsq', 'count'],
+    'max': ['max'],
+    'min': ['min'],
+    'trend': ['sum', 'count', 't', 'tt', 'ty'],
+}
+_combine = {'max': np.fmax, 'min': np.fmin}
+
+def _partial(name, x, ax, t):
+    if name == 'sum':
+        return x.sum(ax)
+    if name == 'sumsq':
+        return (x * x).sum(ax)
+    if name == 'count':
+        return np.array(float(x.shape[ax]))
+    if name == 'max':
+        return np.fmax.reduce(x, ax)
+    if name == 'min':
+        return np.fmin.reduce(x, ax)
+    if name == 't':
+        return np.array(t.sum())
+    if name == 'tt':
+        return np.array((t * t).sum())
+    if name == 'ty':
+        return np.tensordot(x, t, axes=([ax], [0]))
+
+def _finalize(op, p):
+    if op in ['sum', 'max', 'min']:
+        return p[op]
+    m = p['sum'] / p['count']
+    if op == 'mean':
+        return m
+    if op == 'std':
+        return np.sqrt(p['sumsq'] / p['count'] - m ** 2)
+    if op == 'trend':
+        n = p['count']
+        return (n * p['ty'] - p['t'] * p['sum']) / (n * p['tt'] - p['t'] ** 2)
+
+class Plan(object):
+    """Declare several reductions on several variables of one netCDF file up front and evaluate them all in a single pass: each variable's hyperslab is read once, in blocks of **block** steps along **dim**, and every partial result (sums, counts, extrema, ...) is computed once per block and shared between the operations needing it. Reductions along **dim** (the decomposed dimension) are then combined across processors with one ``Allreduce`` for all sums and one for all extrema; reductions along any other dimension return, like :meth:`Data.np_op`, the processor's piece of the result.
+
+    :param path: path to the netCDF file to open
+
+    Keyword arguments::
+
+        **dim** - the dimension along which to slice the data (as for :class:`Data`)
+        **block** - number of steps along **dim** to read at a time (default: the processor's whole slice)
+        **threads** - number of threads computing the partial results of each block (default :data:`n_threads`)
+
+    Any additional **kwargs** are index slices or coordinate value tuples as for :class:`Data`. Supported operations are ``'sum'``, ``'mean'``, ``'std'``, ``'max'``, ``'min'`` and ``'trend'`` (least-squares slope per step along the axis). Missing values are read as ``NaN``; they propagate into ``'sum'``, ``'mean'``, ``'std'`` and ``'trend'``, whereas ``'max'`` and ``'min'`` ignore them (and are ``NaN`` only where all values are missing). Example::
+
+        plan = Plan(path, dim='time', time=('1990', '2000'))
+        plan.add('t2', 'mean', 'time').add('t2', 'max', 'time').add('pr', 'trend', 'time')
+        results = plan.run() # {('t2', 'mean', 'time'): ..., ...}
+
+    Attributes::
+
+        **read_time** - the wall time needed to read the data
+        **op_time** - the wall time spent computing partial results
+        **comm_time** - the wall time spent in the ``Allreduce`` calls
+
+    """
+    def __init__(self, path, dim, block=None, threads=None, **kwargs):
+        self.path = path
+        self.netcdf = Dataset(path, parallel=True, comm=MPI.COMM_WORLD)
+        self.mpi_dim = dim
+        self.block = block
+        self.threads = threads
+        self.kwargs = kwargs
+        self.ops = {}
+
+    def add(self, var, op, ax):
+        """Request operation **op** along dimension **ax** on variable **var**. Returns the plan, so that calls can be chained."""
+        if op not in _needs:
+            raise ValueError('unknown operation {}'.format(op))
+        self.ops.setdefault(var, []).append((op, ax))
+        return self
+
+    def _stream(self, data, ops):
+        m = data.var.dimensions.index(self.mpi_dim)
+        s = data.slices[m]
+        if data.mpi_range.stop - data.mpi_range.start < MPI.COMM_WORLD.Get_size():
+            raise ValueError('fewer steps along {} than processors'.format(self.mpi_dim))
+        step = self.block or max(s.stop - s.start, 1)
+        needs = {ax: set(n for o, a in ops if a == ax for n in _needs[o]) for o, ax in ops}
+        partials = {ax: {} for ax in needs}
+        for b in range(s.start, s.stop, step):
+            sl = list(data.slices)
+            sl[m] = slice(b, min(b + step, s.stop))
+            start = MPI.Wtime()
+            x = np.ma.filled(np.ma.asarray(data.var[sl], dtype=float), np.nan)
+            self.read_time += MPI.Wtime() - start
+            start = MPI.Wtime()
+            for ax, names in needs.items():
+                a = data.var.dimensions.index(ax)
+                t = np.arange(x.shape[a], dtype=float) + (b if a == m else 0)
+                for name in names:
+                    if name in ['count', 't', 'tt']:
+                        p = _partial(name, x, a, t)
+                    else:
+                        p = tiled(lambda z: _partial(name, z, a, t), x, a, self.threads)
+                    q = partials[ax].get(name)
+                    if q is None:
+                        partials[ax][name] = [p] if a != m else p
+                    elif a != m:
+                        q.append(p) # pieces along the decomposed dimension
+                    else:
+                        partials[ax][name] = _combine.get(name, np.add)(q, p)
+            self.op_time += MPI.Wtime() - start
+        for ax, p in partials.items():
+            a = data.var.dimensions.index(ax)
+            if a != m:
+                k = m - 1 if a < m else m
+                for name, q in p.items():
+                    p[name] = q[0] if q[0].ndim == 0 else np.concatenate(q, k)
+        return partials
+
+    def run(self):
+        """Read all variables and evaluate all requested operations.
+
+        :returns: dict with keys ``(var, op, ax)`` and the results as values
+
+        """
+        self.read_time, self.op_time = 0, 0
+        collect = []
+        results = {}
+        partials = {}
+        for var, ops in self.ops.items():
+            data = Data(self.path, var=var, dim=self.mpi_dim, netcdf=self.netcdf, read=False, **self.kwargs)
+            partials[var] = self._stream(data, ops)
+            if self.mpi_dim in partials[var]:
+                collect.append(partials[var][self.mpi_dim])
+        start = MPI.Wtime()
+        if len(collect) > 0:
+            sums = [(p, n) for p in collect for n in sorted(p) if n not in _combine]
+            maxs = [(p, n) for p in collect for n in sorted(p) if n in _combine]
+            # minima are negated so that all extrema go into one MPI.MAX reduction
+            for group, op in [(sums, MPI.SUM), (maxs, MPI.MAX)]:
+                if len(group) == 0:
+                    continue
+                buf = np.concatenate([np.ravel(-p[n] if n == 'min' else p[n]) for p, n in group]).astype(float)
+                if op == MPI.MAX:
+                    # MPI.MAX treats NaN depending on operand order, so missing extrema are sent as -inf
+                    buf[np.isnan(buf)] = -np.inf
+                MPI.COMM_WORLD.Allreduce(MPI.IN_PLACE, buf, op=op)
+                if op == MPI.MAX:
+                    buf[np.isneginf(buf)] = np.nan
+                i = 0
+                for p, n in group:
+                    k = np.size(p[n])
+                    v = buf[i: i + k].reshape(np.shape(p[n]))
+                    p[n] = -v if n == 'min' else v
+                    i += k
+        self.comm_time = MPI.Wtime() - start
+        for var, ops in self.ops.items():
+            for op, ax in ops:
+                results[(var, op, ax)] = _finalize(op, partials[var][ax])
+        return results
 
 # rearrangement for the np-function call
 def concat_np(view, var, dim):
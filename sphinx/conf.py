@@ -40,7 +40,7 @@ extensions = [
     'sphinx.ext.githubpages',
 ]
 
-autodoc_mock_imports = ['fs.sshfs', 'urllib3.util']
+autodoc_mock_imports = ['fs.sshfs', 'urllib3.util', 'paramiko', 'mpi4py', 'netCDF4']
 
 # Add any paths that contain templates here, relative to this directory.
 templates_path = ['_templates']
@@ -27,8 +27,8 @@ Running scripts is supported via the :class:`SSHFSRunner` class, which uses the
 from importlib.machinery import ModuleSpec
 from importlib.util import module_from_spec
 from importlib import import_module
-from traitlets.config import Application
-from traitlets.config.loader import PyFileConfigLoader
+from traitlets.config import Application, Config
+from traitlets.config.loader import PyFileConfigLoader, ConfigFileNotFound
 from traitlets import Unicode, Integer, Bool, Dict
 from fs.sshfs import SSHFS
 import sys, os, re
@@ -67,7 +67,10 @@ class SSHFSConnect(Application):
 
 
     def __init__(self, *args, **kwargs):
-        config = PyFileConfigLoader('config.py', os.path.dirname(os.path.realpath(__file__))).load_config()
+        try:
+            config = PyFileConfigLoader('config.py', os.path.dirname(os.path.realpath(__file__))).load_config()
+        except ConfigFileNotFound:
+            config = Config()
         if 'config' in kwargs:
             config.merge(kwargs.pop('config', {}))
         super().__init__(*args, config=config, **kwargs)